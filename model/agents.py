@@ -6,7 +6,8 @@ from shapely.geometry import Point
 from shapely import contains_xy
 
 # Import functions from functions.py
-from functions import generate_random_location_within_map_domain, get_flood_depth, calculate_basic_flood_damage, floodplain_multipolygon, load_flood_map, expected_utility_prospect_theory, risk_perception_bayesian_PT
+from functions import generate_random_location_within_map_domain, get_flood_depth, calculate_basic_flood_damage, floodplain_multipolygon, load_flood_map, expected_utility_prospect_theory
+from functions import draw_prospect_theory_parameters, household_risk_perception, update_expected_utility_memoized, household_adaptation_decision
 
 
 # Define the Households agent class
@@ -17,7 +18,24 @@ class Households(Agent):
     In a real scenario, this would be based on actual geographical data or more complex logic.
     """
 
-    def __init__(self, unique_id, model, savings_range):
+    # Threshold of minimum savings housholds still have after taking adaption measures
+    savings_threshold = 5000
+
+    # Income categories and the share of households in each category (income distribution in Houston)
+    income_categories = ('low', 'middle', 'high')
+    income_weights = (0.34, 0.29, 0.37)
+
+    # Percived flood risk of each flood scenario # TODO: what are the assumptions behind this?
+    default_flood_risk = (0.05, 0.15, 0.3, 0.5)
+    # Cost of adaption measures to lift to 1.3 m above ground level
+    default_cost_measure = 35000
+
+    def __init__(self, unique_id, model, savings_range, attributes=None):
+        """
+        attributes: optional dictionary with the initial attributes of this household (income_category, savings, RPt
+        and any additional parameters), as drawn for the whole population by build_household_population.
+        If None, the attributes are drawn for this household only.
+        """
         super().__init__(unique_id, model)
         
         self.is_adapted = False  # Initial adaptation status set to False
@@ -25,55 +43,52 @@ class Households(Agent):
         
         self.savings_range = savings_range  # Add savings attribute
     
-        # Assign agent to an income category based on the income distribution in Houston #TODO: Source
-        self.income_category = random.choices(['low', 'middle', 'high'], weights=[0.34, 0.29, 0.37])[0]
-    
-        # Assign income-specific attributes based on the category
-        if self.income_category == 'low':
-            self.savings = random.randint(self.savings_range[0][0], self.savings_range[0][1])
-            # additional attributes for low income households if needed
-        elif self.income_category == 'middle':
-            self.savings = random.randint(self.savings_range[1][0], self.savings_range[1][1])
-            # additional attributes for middle income households if needed
-        elif self.income_category == 'high':
-            self.savings = random.randint(self.savings_range[2][0], self.savings_range[2][1])
-            # additional attributes for high income households if needed
+        # Assign agent to an income category and income-specific attributes
+        self.initialize_income_and_savings(attributes)
 
         #TODO: integrate housing size for each income category? this should be connected to the damage function
 
-        # getting flood map values
-        # Get a random location on the map
-        loc_x, loc_y = generate_random_location_within_map_domain()
-        self.location = Point(loc_x, loc_y)
-
-        # Check whether the location is within floodplain
-        self.in_floodplain = False
-        if contains_xy(geom=floodplain_multipolygon, x=self.location.x, y=self.location.y):
-            self.in_floodplain = True
-
-        # List of flood map choices
-        flood_map_choices = ['harvey', '100yr', '500yr']
-
-        # List to store flood_depth_estimated for each choice
-        self.flood_depth_estimated_list = []
-
-        # Calculate flood_depth_estimated for each choice
-        for choice in flood_map_choices:
-            # Load the flood map
-            flood_map = load_flood_map(choice)
-            # Update the band
-            model.band_flood_img = flood_map.read(1)
-            # Get the estimated flood depth at those coordinates
-            self.flood_depth_estimated = get_flood_depth(corresponding_map=flood_map, location=self.location, band=model.band_flood_img)
-  
-            # Flood depth can be negative if the location is at a high elevation
-            # handle negative values of flood depth
-            if self.flood_depth_estimated < 0:
-                self.flood_depth_estimated = 0
-            self.flood_depth_estimated_list.append(self.flood_depth_estimated)
-
-        # Add an additional last list element with the value of 0 for the flood depth in the case of no flooding
-        self.flood_depth_estimated_list.append(0)
+        if attributes is not None and 'flood_depth' in attributes:
+            # Location, floodplain membership and estimated flood depths drawn beforehand for the whole population
+            # (see build_household_locations), the last flood depth is 0 for the case of no flooding
+            self.location = Point(*attributes['coordinates'])
+            self.in_floodplain = bool(attributes['in_floodplain'])
+            self.flood_depth_estimated_list = [float(flood_depth) for flood_depth in attributes['flood_depth']]
+            self.flood_depth_estimated = self.flood_depth_estimated_list[-2]
+        else:
+            # getting flood map values
+            # Get a random location on the map
+            loc_x, loc_y = generate_random_location_within_map_domain()
+            self.location = Point(loc_x, loc_y)
+
+            # Check whether the location is within floodplain
+            self.in_floodplain = False
+            if contains_xy(geom=floodplain_multipolygon, x=self.location.x, y=self.location.y):
+                self.in_floodplain = True
+
+            # List of flood map choices
+            flood_map_choices = ['harvey', '100yr', '500yr']
+
+            # List to store flood_depth_estimated for each choice
+            self.flood_depth_estimated_list = []
+
+            # Calculate flood_depth_estimated for each choice
+            for choice in flood_map_choices:
+                # Load the flood map
+                flood_map = load_flood_map(choice)
+                # Update the band
+                model.band_flood_img = flood_map.read(1)
+                # Get the estimated flood depth at those coordinates
+                self.flood_depth_estimated = get_flood_depth(corresponding_map=flood_map, location=self.location, band=model.band_flood_img)
+      
+                # Flood depth can be negative if the location is at a high elevation
+                # handle negative values of flood depth
+                if self.flood_depth_estimated < 0:
+                    self.flood_depth_estimated = 0
+                self.flood_depth_estimated_list.append(self.flood_depth_estimated)
+
+            # Add an additional last list element with the value of 0 for the flood depth in the case of no flooding
+            self.flood_depth_estimated_list.append(0)
         
         # Calculate the estimated flood damage given the estimated flood depth. Flood damage is a factor between 0 and 1
         self.flood_damage_estimated_list = []
@@ -81,10 +96,58 @@ class Households(Agent):
             self.flood_damage_estimated_list.append(calculate_basic_flood_damage(flood_depth=flood_depth))
         
         # Create a list with percived flood risk
-        self.flood_risk = [0.05, 0.15, 0.3, 0.5] # TODO: what are the assumptions behind this?
+        self.flood_risk = list(self.default_flood_risk)
         
         # Cost of adaption measures to lift to 1.3 m above ground level
-        self.cost_measure = 35000
+        self.cost_measure = self.default_cost_measure
+
+        # Behavioural parameters, risk perception and expected utilities at the start of the simulation
+        self.initialize_behaviour(attributes)
+
+        # Additional parameters drawn for the whole population
+        if attributes is not None:
+            self.set_additional_attributes(attributes)
+
+    def initialize_income_and_savings(self, attributes):
+        """
+        Set the income category and savings of the household, from the attributes drawn for the whole population
+        or, if attributes is None, drawn for this household only. Shared by Households and CompactHouseholds.
+        """
+        if attributes is not None:
+            # Income category and savings drawn beforehand for the whole population
+            self.income_category = str(attributes['income_category'])
+            self.savings = int(attributes['savings'])
+        else:
+            # Assign agent to an income category based on the income distribution in Houston #TODO: Source
+            self.income_category = random.choices(self.income_categories, weights=self.income_weights)[0]
+        
+            # Assign income-specific attributes based on the category
+            if self.income_category == 'low':
+                self.savings = random.randint(self.savings_range[0][0], self.savings_range[0][1])
+                # additional attributes for low income households if needed
+            elif self.income_category == 'middle':
+                self.savings = random.randint(self.savings_range[1][0], self.savings_range[1][1])
+                # additional attributes for middle income households if needed
+            elif self.income_category == 'high':
+                self.savings = random.randint(self.savings_range[2][0], self.savings_range[2][1])
+                # additional attributes for high income households if needed
+
+    def initialize_behaviour(self, attributes):
+        """
+        Set the prospect theory parameters, the actual flood depth and damage, the risk perception and the expected
+        utilities at the start of the simulation. Shared by Households and CompactHouseholds.
+        """
+        # Prospect theory parameters (delta, lambda, theta) are either drawn once at creation
+        # or, by default, drawn anew on every evaluation of the utility functions
+        if self.model.persistent_behavioural_parameters:
+            self.delta, self.lambda_val, self.theta = draw_prospect_theory_parameters()
+        else:
+            self.delta, self.lambda_val, self.theta = None, None, None
+
+        # Memoized utility per flood scenario for adaptation=True and adaptation=False, only used with persistent parameters
+        self.utilities_measure = None
+        self.utilities_nomeasure = None
+        self.utilities_subsidie = None  # subsidy level the memoized utilities were computed for
 
         # Add an attribute for the actual flood depth. This is set to zero at the beginning of the simulation since there is not flood yet
         # and will update its value when there is a shock (i.e., actual flood). Shock happens at some point during the simulation
@@ -95,15 +158,26 @@ class Households(Agent):
         
         # the individual risk perception (RP) at time (t) (= RPt) is a value between 0 and 1
         # The risk perception RPt of individuals canlead to a positive or negative misjudgment of theprobability of a flood by a factor of 10 from the objective probability flood_risk
-        self.RPt = np.random.normal(0.5, 0.5)
-        # Ensure RPt is within [0, 1]
-        self.RPt = max(0, min(self.RPt, 1))
+        if attributes is not None:
+            self.RPt = float(attributes['RPt'])
+        else:
+            self.RPt = np.random.normal(0.5, 0.5)
+            # Ensure RPt is within [0, 1]
+            self.RPt = max(0, min(self.RPt, 1))
         
         # initialization of the risk perception at time (t-1) (= RPt_1) to store the risk perception of the previous time step
         self.RPt_1 = None
+        # buffer for the risk perception of the next time step, only used with synchronous activation
+        self.RPt_next = None
         
         self.expected_utility_measure = 0 # Initialize the expected utility for adaptation=True
         self.expected_utility_nomeasure = 0 # Initialize the expected utility for adaptation=False
+
+    def set_additional_attributes(self, attributes):
+        """Set the attributes other than income_category, savings, RPt and the location, e.g. parameters drawn from the input data."""
+        for name, value in attributes.items():
+            if name not in ('income_category', 'savings', 'RPt', 'in_floodplain', 'coordinates', 'flood_depth'):
+                setattr(self, name, value.item() if isinstance(value, np.generic) else value)
     
     # Function to count friends who can be influencial.
     def count_friends(self, radius):
@@ -113,21 +187,56 @@ class Households(Agent):
 
     def step(self):
         
-        self.RPt_1 = self.RPt # store the risk perception of the previous time step
+        # With synchronous activation all households read the risk perception of the previous step,
+        # the new risk perception is stored in a buffer and applied in advance
+        if self.model.synchronous_activation:
+            self.RPt_next = self.updated_risk_perception()
+            return
         
+        self.RPt_1 = self.RPt # store the risk perception of the previous time step
+        self.RPt = self.updated_risk_perception()
+        self.decide_adaptation()
+
+    def advance(self):
+        """Apply the risk perception computed in step and decide on adaptation (synchronous activation only)."""
+        self.RPt_1 = self.RPt # store the risk perception of the previous time step
+        self.RPt = self.RPt_next
+        self.decide_adaptation()
+
+    def updated_risk_perception(self):
+        """Return the risk perception of this step, based on the current risk perception of the household and its neighbors."""
         # count neighbors within a radius of 1
         if self.count_friends(radius=1) > 0:
-            I_social = np.mean([neighbor.RPt for neighbor in self.model.grid.get_neighbors(self.pos)]) # the social influence is the average risk perception of the neighbors
+            neighbor_risk_perceptions = [neighbor.RPt for neighbor in self.model.grid.get_neighbors(self.pos)]
         else:
-            I_social = 1 # according to Haer et al. (2017) the social influence is considered 1.0 if its closest to their own risk perception, i.e., no social influence
-        
-        self.RPt = risk_perception_bayesian_PT(RPt_1=self.RPt_1, I_social= I_social, I_media=self.model.government.information, flood_occurs=self.model.flood_occurs)
+            neighbor_risk_perceptions = []
         
+        return household_risk_perception(self, neighbor_risk_perceptions, I_media=self.model.government.information, flood_occurs=self.model.flood_occurs)
+
+    def decide_adaptation(self):
+        """Update the expected utilities with the risk perception of this step and decide on adaptation."""
         # Expected utility based on the prospect theory, Source:
         # Haer, T., Botzen, W. J. W., de Moel, H., & Aerts, J. C. J. H. (2017).
         # Integrating Household Risk Mitigation Behavior in Flood Risk Analysis: An Agent-Based Model Approach.
         # Risk Analysis, 37(10), 1977–1992. https://doi.org/10.1111/risa.12740
         
+        # With persistent parameters only the risk perception dependent part has to be evaluated each step
+        if self.delta is not None:
+            self.update_expected_utility_memoized()
+        else:
+            self.update_expected_utility()
+        
+        # Random factor between 0.95 and 1.05 to simulate savings and expenses of the household
+        if self.model.synchronous_activation:
+            # drawn per household by the model, so the result does not depend on the activation order
+            savings_factor = self.model.savings_factors[self.unique_id]
+        else:
+            savings_factor = random.uniform(0.95, 1.05)
+        
+        household_adaptation_decision(self, subsidie=self.model.government.subsidies, step=self.model.schedule.steps, savings_factor=savings_factor)
+
+    def update_expected_utility(self):
+        """Add the expected utilities of this step, drawing new prospect theory parameters for every evaluation."""
         # Sum the expected utilities for each flood risk and perceived flood damage to get the total expected utility for action=True and action=False
         for risk_of_flood, perceived_flood_damage in zip(self.flood_risk, self.flood_damage_estimated_list):
             # Calculate the expected utility for adaptation=True
@@ -151,23 +260,90 @@ class Households(Agent):
                                                                         )
             # Add the result to the sum for adaptation=False
             self.expected_utility_nomeasure += utility_adaptation_false
+
+    def update_expected_utility_memoized(self):
+        """
+        Add the expected utilities of this step using the household's persistent prospect theory parameters,
+        see update_expected_utility_memoized in functions.py.
+        """
+        update_expected_utility_memoized(self, subsidie=self.model.government.subsidies)
         
-        # Threshold of minimum savings housholds still have after taking adaption measures
-        savings_threshold = 5000
-        
-        # Logic for adaptation based on estimated flood damage and a random chance.
-        # These conditions are examples and should be refined for real-world applications.
-        if self.expected_utility_measure > self.expected_utility_nomeasure and self.savings > (self.cost_measure - self.model.government.subsidies + savings_threshold):
-            self.is_adapted = True  # Agent adapts to flooding
-            self.savings = self.savings - self.cost_measure  # Agent pays for adaptation measures
-            self.adapted_at_t = self.model.schedule.steps  # Set the time step at which the agent adapts
-        
-        # Multiply the savings with a random factor between 0.95 and 1.15 to simulate savings and expenses of the household
-        self.savings = self.savings * random.uniform(0.95, 1.05)
         
+# Define the memory-compact Households agent class
+class CompactHouseholds(Households):
+    """
+    A memory-compact version of the Households agent with the same behaviour and attribute names.
+    Constants that are the same for every household live on the class, per-agent state is stored in slots,
+    and the coordinates and estimated flood depths and damages are views on arrays owned by the model.
+    The model has to allocate these arrays (see AdaptationModel.allocate_household_arrays) before creating the agents.
+
+    The instances still have a __dict__, since the Mesa Agent base class has no __slots__. It holds the attributes
+    set by Mesa (unique_id, model and pos) and the additional attributes from the input data (set_additional_attributes),
+    so the saving comes from the slots, the shared constants and the model-level arrays only. memory_benchmark.py
+    reports the size of the remaining __dict__.
+    """
+
+    # Shared constants, identical for every household
+    flood_risk = Households.default_flood_risk
+    cost_measure = Households.default_cost_measure
+
+    __slots__ = ('row', 'savings_range', 'is_adapted', 'adapted_at_t', 'income_category', 'savings', 'in_floodplain',
+                 'flood_depth_actual', 'flood_damage_actual', 'RPt', 'RPt_1', 'RPt_next',
+                 'expected_utility_measure', 'expected_utility_nomeasure',
+                 'delta', 'lambda_val', 'theta', 'utilities_measure', 'utilities_nomeasure', 'utilities_subsidie')
+
+    def __init__(self, unique_id, model, row, savings_range, attributes=None):
+        # Skip Households.__init__, the location and flood depths are stored in the model-level arrays instead.
+        # The other attributes are set with the same helpers as in Households, in the same order
+        Agent.__init__(self, unique_id, model)
         
+        self.row = row  # row of this household in the model-level household arrays
         
+        self.is_adapted = False  # Initial adaptation status set to False
+        self.adapted_at_t = None  # Initialize the time step at which the agent adapts to None
         
+        self.savings_range = savings_range  # shared with the other households of the model
+        self.initialize_income_and_savings(attributes)
+
+        if attributes is not None and 'in_floodplain' in attributes:
+            # Generated population (see population.py): the location and estimated flood depths and damages
+            # are already in the model-level arrays
+            self.in_floodplain = bool(attributes['in_floodplain'])
+        else:
+            # Get a random location on the map and store it in the model-level coordinate array
+            loc_x, loc_y = generate_random_location_within_map_domain()
+            model.household_coordinates[row] = loc_x, loc_y
+            self.in_floodplain = bool(contains_xy(geom=floodplain_multipolygon, x=loc_x, y=loc_y))
+
+            # Estimated flood depth for each flood map, the last column stays 0 for the case of no flooding.
+            # The flood maps are loaded once by the model instead of once per household
+            location = self.location
+            for column, (flood_map, band) in enumerate(model.household_flood_maps.values()):
+                model.household_flood_depths[row, column] = max(get_flood_depth(corresponding_map=flood_map, location=location, band=band), 0)
+            for column, flood_depth in enumerate(model.household_flood_depths[row]):
+                model.household_flood_damages[row, column] = calculate_basic_flood_damage(flood_depth=flood_depth)
+
+        self.initialize_behaviour(attributes)
+
+        if attributes is not None:
+            self.set_additional_attributes(attributes)
+
+    @property
+    def location(self):
+        """Location of the household as a Shapely Point, created on access from the model-level coordinate array."""
+        return Point(self.model.household_coordinates[self.row])
+
+    @property
+    def flood_depth_estimated_list(self):
+        """View on the estimated flood depths ('harvey', '100yr', '500yr', no flood) of the household."""
+        return self.model.household_flood_depths[self.row]
+
+    @property
+    def flood_damage_estimated_list(self):
+        """View on the estimated flood damages ('harvey', '100yr', '500yr', no flood) of the household."""
+        return self.model.household_flood_damages[self.row]
+
+
 # Define the Government agent class
 class Government(Agent):
     """
@@ -196,7 +372,7 @@ class Government(Agent):
             self.spendings += 2000 * factor # the spendings are positive but should be interpreted as negative values (in USD)
         
         if self.subsidies > 0:
-            total_adapted_households = sum([1 for agent in self.model.schedule.agents if agent.is_adapted == True])
+            total_adapted_households = self.model.total_adapted_households()
             num_newly_adapted_households = total_adapted_households - self.previous_adapted_households
             self.spendings += self.subsidies * num_newly_adapted_households
             self.previous_adapted_households = total_adapted_households
@@ -8,6 +8,7 @@ Functions get called by the Model and Agent class.
 import random
 import numpy as np
 import math
+from functools import lru_cache
 from shapely import contains_xy
 from shapely import prepare
 import geopandas as gpd
@@ -47,6 +48,130 @@ def set_initial_values(input_data, parameter, seed):
     return parameter_set
 
 
+def compile_distribution_table(input_data, parameter):
+    """
+    Compile the distribution of a parameter in the input data once into arrays, so the values of
+    many households can be set at once with sample_distribution_table.
+    
+    Parameters
+    ----------
+    input_data: the dataframe containing the distribution of paramters
+    parameter: parameter name that is to be compiled
+    
+    Returns
+    -------
+    thresholds, values: cumulative percentages (value_for_input) and the corresponding values of the parameter
+    """
+    parameter_data = input_data.loc[(input_data.parameter == parameter)] # get the distribution of values for the specified parameter
+    thresholds = parameter_data['value_for_input'].to_numpy(dtype=float)
+    values = parameter_data['value'].to_numpy()
+    return thresholds, values
+
+
+def sample_distribution_table(distribution_table, random_parameters):
+    """
+    Vectorized version of set_initial_values: map random integers between 0 and 100 to parameter values
+    with one searchsorted, using the same interval rules as set_initial_values.
+    
+    Parameters
+    ----------
+    distribution_table: thresholds and values as returned by compile_distribution_table
+    random_parameters: array of random integers between 0 and 100, one per household
+    
+    Returns
+    -------
+    parameter_set: array with the value of the parameter for each household (0 if no interval matches)
+    """
+    thresholds, values = distribution_table
+    random_parameters = np.asarray(random_parameters)
+    # first interval i with random_parameter <= thresholds[i], the first interval excludes its upper bound
+    index = np.searchsorted(thresholds, random_parameters, side='left')
+    index = np.where(random_parameters >= thresholds[0], np.maximum(index, 1), index)
+    # values that do not fall in any interval are set to 0, as in set_initial_values
+    matched = index < len(thresholds)
+    parameter_set = np.zeros(len(random_parameters), dtype=np.result_type(values.dtype, int))
+    parameter_set[matched] = values[index[matched]]
+    return parameter_set
+
+
+def build_household_population(number_of_households, rng, input_data=None, parameters=(),
+                               income_categories=('low', 'middle', 'high'), income_weights=(0.34, 0.29, 0.37),
+                               savings_levels=((0, 20000), (20000, 70000), (70000, 250000))):
+    """
+    Draw the initial attributes of all households at once instead of per agent.
+    Uses the same distributions as Households: the income category from the income distribution in Houston,
+    the savings uniformly within the range of the income category and the initial risk perception RPt
+    from a normal distribution clipped to [0, 1]. Additional parameters are drawn from their distribution in the input data.
+    
+    Parameters
+    ----------
+    number_of_households: number of households to draw attributes for
+    rng: numpy random Generator
+    input_data: the dataframe containing the distribution of additional paramters, as used in set_initial_values
+    parameters: names of the additional parameters in input_data
+    income_categories, income_weights: income categories and the share of households in each category
+    savings_levels: range of savings (inclusive) for each income category
+    
+    Returns
+    -------
+    population: dictionary with an array of length number_of_households for each attribute
+    """
+    population = {}
+    
+    # income category, one searchsorted on the cumulative income distribution
+    cumulative_weights = np.cumsum(income_weights)
+    income_index = np.searchsorted(cumulative_weights, rng.random(number_of_households) * cumulative_weights[-1], side='right')
+    income_index = np.minimum(income_index, len(income_categories) - 1)
+    population['income_category'] = np.asarray(income_categories)[income_index]
+    
+    # savings uniformly within the savings range of the income category
+    savings_levels = np.asarray(savings_levels)
+    population['savings'] = rng.integers(savings_levels[income_index, 0], savings_levels[income_index, 1], endpoint=True)
+    
+    # initial risk perception within [0, 1]
+    population['RPt'] = np.clip(rng.normal(0.5, 0.5, number_of_households), 0, 1)
+    
+    # additional parameters, each compiled once and assigned with one searchsorted
+    for parameter in parameters:
+        distribution_table = compile_distribution_table(input_data, parameter)
+        population[parameter] = sample_distribution_table(distribution_table, rng.integers(0, 100, number_of_households, endpoint=True))
+    
+    return population
+
+
+def _splitmix64(x):
+    """SplitMix64 finalizer of an array of unsigned 64-bit integers, a bijective hash with well mixed bits."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def draw_savings_factors(seed, step, unique_ids):
+    """
+    Draw the random factor between 0.95 and 1.05 with which the savings of each household are multiplied in a step.
+    Each factor is a counter-based random number keyed by the seed, the step and the unique_id of the household,
+    so it is the same no matter in which order, in which process or together with which other households
+    the households are stepped (used with synchronous activation).
+    
+    Parameters
+    ----------
+    seed: seed of the model run, an integer between 0 and 2**64 - 1
+    step: current step of the model
+    unique_ids: unique_ids of the households to draw the factor for
+    
+    Returns
+    -------
+    savings_factors: array with the factor for each of the unique_ids, in the same order
+    """
+    with np.errstate(over='ignore'):  # the hash relies on wrap-around of the 64-bit arithmetic
+        key = _splitmix64(_splitmix64(np.array([seed], dtype=np.uint64)) ^ np.uint64(step))
+        bits = _splitmix64(key ^ np.asarray(unique_ids, dtype=np.uint64))
+    # the upper 53 bits give a uniform number in [0, 1) with the full precision of a double
+    uniform = (bits >> np.uint64(11)).astype(float) * 2.0**-53
+    return 0.95 + 0.1 * uniform
+
+
 def get_flood_map_data(flood_map):
     """
     Getting the flood map characteristics.
@@ -100,6 +225,62 @@ def generate_random_location_within_map_domain():
         if contains_xy(map_domain_polygon, x, y):
             return x, y
 
+def generate_random_locations_within_map_domain(number_of_locations, rng):
+    """
+    Generate many random location coordinates within the map domain polygon at once.
+
+    Parameters
+    ----------
+    number_of_locations: number of locations to generate
+    rng: numpy random Generator
+
+    Returns
+    -------
+    x, y: arrays of location coordinates, longitude and latitude
+    """
+    x = np.empty(number_of_locations)
+    y = np.empty(number_of_locations)
+    count = 0
+    while count < number_of_locations:
+        # generate random location coordinates within square area of map domain and keep those within the polygon
+        missing = number_of_locations - count
+        candidate_x = rng.uniform(map_minx, map_maxx, 2 * missing)
+        candidate_y = rng.uniform(map_miny, map_maxy, 2 * missing)
+        inside = contains_xy(map_domain_polygon, candidate_x, candidate_y)
+        accepted = min(int(inside.sum()), missing)
+        x[count:count + accepted] = candidate_x[inside][:accepted]
+        y[count:count + accepted] = candidate_y[inside][:accepted]
+        count += accepted
+    return x, y
+
+def build_household_locations(number_of_households, rng, flood_maps):
+    """
+    Draw the locations of all households at once and look up whether they are within the floodplain and their
+    estimated flood depth for each flood map, instead of per agent. Negative flood depths are set to 0, as in Households.
+
+    Parameters
+    ----------
+    number_of_households: number of households to draw locations for
+    rng: numpy random Generator
+    flood_maps: list of (flood map, band) pairs, each flood map loaded once, in the order of the flood depth columns
+
+    Returns
+    -------
+    locations: dictionary with the coordinates (number_of_households x 2), in_floodplain and flood_depth
+    (number_of_households x number of flood maps + 1, the last column is 0 for the case of no flooding)
+    """
+    x, y = generate_random_locations_within_map_domain(number_of_households, rng)
+    flood_depth = np.zeros((number_of_households, len(flood_maps) + 1))
+    for column, (flood_map, band) in enumerate(flood_maps):
+        # same indexing as get_flood_depth
+        rows, cols = flood_map.index(x, y)
+        flood_depth[:, column] = np.maximum(band[np.asarray(rows) - 1, np.asarray(cols) - 1], 0)
+    return {
+        'coordinates': np.column_stack((x, y)),
+        'in_floodplain': contains_xy(floodplain_multipolygon, x, y),
+        'flood_depth': flood_depth,
+    }
+
 def get_flood_depth(corresponding_map, location, band):
     """ 
     To get the flood depth of a specific location within the model domain.
@@ -165,6 +346,25 @@ def calculate_basic_flood_damage(flood_depth):
         flood_damage = 0.1746 * math.log(flood_depth) + 0.6483
     return flood_damage * 100000 # multiply the flood damage with 100000 to get the damage in USD
 
+# Vectorized version of calculate_basic_flood_damage for many households at once
+def calculate_basic_flood_damage_array(flood_depth):
+    """
+    To get flood damage based on flood depth for an array of households, see calculate_basic_flood_damage.
+    
+    Parameters
+    ----------
+    flood_depth : array of flood depths
+
+    Returns
+    -------
+    flood_damage : array of flood damages in USD
+    """
+    flood_depth = np.asarray(flood_depth, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flood_damage = 0.1746 * np.log(flood_depth) + 0.6483
+    flood_damage = np.where(flood_depth >= 6, 1, np.where(flood_depth < 0.025, 0, flood_damage))
+    return flood_damage * 100000 # multiply the flood damage with 100000 to get the damage in USD
+
 # Function to calculate the flood damage when an adaptation measure is taken
 def calculate_adapted_flood_damage(flood_depth):
     """
@@ -191,6 +391,25 @@ def calculate_adapted_flood_damage(flood_depth):
     return flood_damage * 100000 # multiply the flood damage with 100000 to get the damage in USD
 #TODO: take hosuing size into consideration depending on income class?
 
+# Vectorized version of calculate_adapted_flood_damage for many households at once
+def calculate_adapted_flood_damage_array(flood_depth):
+    """
+    To get flood damage based on flood depth for an array of adapted households, see calculate_adapted_flood_damage.
+    
+    Parameters
+    ----------
+    flood_depth : array of flood depths
+
+    Returns
+    -------
+    flood_damage : array of flood damages in USD
+    """
+    flood_depth = np.asarray(flood_depth, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flood_damage = 0.1746 * np.log(flood_depth - 1.3) + 0.6483
+    flood_damage = np.where(flood_depth >= 7.3, 1, np.where(flood_depth < 1.325, 0, flood_damage))
+    return flood_damage * 100000 # multiply the flood damage with 100000 to get the damage in USD
+
 
 # Expected utility based on the prospect theory, Source:
 # Haer, T., Botzen, W. J. W., de Moel, H., & Aerts, J. C. J. H. (2017).
@@ -245,7 +464,7 @@ def expected_utility_prospect_theory(risk_of_flood, percieved_flood_damage, RPt,
     
     return pi ** delta / (pi ** delta + (1 - pi) ** delta) ** (1 / delta)
 
-def subjective_weighting_probability_bayesian_PT(p_i, RPt, mean_delta=0.69, std_delta=0.025):
+def subjective_weighting_probability_bayesian_PT(p_i, RPt, mean_delta=0.69, std_delta=0.025, delta=None):
     """
     Calculate the subjective weighting of the probability of a flood.
 
@@ -254,12 +473,14 @@ def subjective_weighting_probability_bayesian_PT(p_i, RPt, mean_delta=0.69, std_
     - RPt: Previous risk perception
     - mean_delta: Mean of the delta parameter
     - std_delta: Standard deviation of the delta parameter
+    - delta: Fixed delta parameter of the household. If None, delta is drawn anew
 
     Returns:
     - Subjective weighting of the probability
     """
-        
-    delta = np.random.normal(mean_delta, std_delta) # delta: Heterogeneity parameter drawn from a random distribution for each household
+    
+    if delta is None:
+        delta = np.random.normal(mean_delta, std_delta) # delta: Heterogeneity parameter drawn from a random distribution for each household
     
     #RPt = risk_perception_bayesian_PT(RPt_1, I_social, I_media, flood_occurs) # Equation (6)
     
@@ -318,7 +539,7 @@ def risk_perception_bayesian_PT(RPt_1, I_social, I_media, flood_occurs):
     # Equation (6)
     return (a * RPt_1 + b * I_experience + c * I_social + d * I_media) / (a + b + c + d)
 
-def utility_function_prospect_theory(x, mean_lambda=2.25, std_lambda=1, mean_theta=0.88, std_theta=0.065):
+def utility_function_prospect_theory(x, mean_lambda=2.25, std_lambda=1, mean_theta=0.88, std_theta=0.065, lambda_val=None, theta=None):
     """
     General utility function for the prospect theory model.
 
@@ -328,15 +549,176 @@ def utility_function_prospect_theory(x, mean_lambda=2.25, std_lambda=1, mean_the
     - std_lambda: Standard deviation of the lambda parameter
     - mean_theta: Mean of the theta parameter
     - std_theta: Standard deviation of the theta parameter
+    - lambda_val: Fixed lambda parameter of the household. If None, lambda is drawn anew
+    - theta: Fixed theta parameter of the household. If None, theta is drawn anew
 
     Returns:
     - Utility for the outcome
     """
     
+    if lambda_val is None:
+        lambda_val = np.random.normal(mean_lambda, std_lambda)
+    if theta is None:
+        theta = np.random.normal(mean_theta, std_theta)
+    
+    return -lambda_val * (-x) ** theta
+
+
+def draw_prospect_theory_parameters(mean_delta=0.69, std_delta=0.025, mean_lambda=2.25, std_lambda=1, mean_theta=0.88, std_theta=0.065):
+    """
+    Draw the prospect theory parameters of a single household once, so they can be kept for the whole simulation.
+    Uses the same distributions as subjective_weighting_probability_bayesian_PT and utility_function_prospect_theory.
+
+    Returns:
+    - delta, lambda_val, theta: Prospect theory parameters of the household
+    """
+    delta = np.random.normal(mean_delta, std_delta)
     lambda_val = np.random.normal(mean_lambda, std_lambda)
     theta = np.random.normal(mean_theta, std_theta)
+    return delta, lambda_val, theta
+
+
+def outcome_utilities_prospect_theory(flood_damage_list, cost_of_measure, subsidie, lambda_val, theta):
+    """
+    Precompute the utility of every (scenario, damage) pair for a household with fixed prospect theory parameters.
+    These values do not depend on the risk perception and can therefore be memoized for the whole simulation.
+
+    Parameters:
+    - flood_damage_list: Perceived flood damage for each flood scenario
+    - cost_of_measure: Cost of adaptation measure
+    - subsidie: Subsidy for adaptation measure
+    - lambda_val: Fixed lambda parameter of the household
+    - theta: Fixed theta parameter of the household
+
+    Returns:
+    - utilities_measure, utilities_nomeasure: arrays with the utility per scenario for action taken and no action taken
+    """
+    utilities_measure = np.array([utility_function_prospect_theory(-cost_of_measure+subsidie-calculate_adapted_flood_damage(damage), lambda_val=lambda_val, theta=theta)
+                                  for damage in flood_damage_list])
+    utilities_nomeasure = np.array([utility_function_prospect_theory(-calculate_basic_flood_damage(damage), lambda_val=lambda_val, theta=theta)
+                                    for damage in flood_damage_list])
+    return utilities_measure, utilities_nomeasure
+
+
+# Resolution of the risk perception grid and the delta grid of the weighting table.
+# The delta grid covers the mean of delta (0.69) plus and minus four standard deviations (0.025)
+RPT_TABLE_RESOLUTION = 1000
+DELTA_TABLE_MIN = 0.59
+DELTA_TABLE_MAX = 0.79
+DELTA_TABLE_RESOLUTION = 200
+
+@lru_cache(maxsize=4)
+def subjective_weighting_table(flood_risk, rpt_resolution=RPT_TABLE_RESOLUTION, delta_resolution=DELTA_TABLE_RESOLUTION):
+    """
+    Lookup table of the subjective weighting of the probability of a flood on a quantized (delta, risk perception) grid.
+    The table only depends on the flood risks, so one table is shared by all households.
+
+    Parameters:
+    - flood_risk: Tuple with the probability of a flood for each scenario
+    - rpt_resolution: Number of intervals the risk perception range [0, 1] is divided into
+    - delta_resolution: Number of intervals the delta range [DELTA_TABLE_MIN, DELTA_TABLE_MAX] is divided into
+
+    Returns:
+    - table: array of shape (delta_resolution + 1, rpt_resolution + 1, len(flood_risk)),
+      table[j, i] holds the weights for delta = DELTA_TABLE_MIN + j * step and RPt = i / rpt_resolution
+    """
+    delta = np.linspace(DELTA_TABLE_MIN, DELTA_TABLE_MAX, delta_resolution + 1)[:, np.newaxis, np.newaxis]
+    RPt = np.linspace(0, 1, rpt_resolution + 1)[np.newaxis, :, np.newaxis]
+    p_i = np.asarray(flood_risk)[np.newaxis, np.newaxis, :]
+    # Same as equation (7) in subjective_weighting_probability_bayesian_PT, evaluated for the whole grid at once
+    scaled_p_i = 10**(2 * RPt - 1) * p_i
+    table = (np.abs(scaled_p_i)**delta) / ((np.abs(scaled_p_i)**delta + np.abs(1 - scaled_p_i)**delta)**(1/delta))
+    table.setflags(write=False)
+    return table
+
+
+def lookup_subjective_weighting(flood_risk, RPt, delta, rpt_resolution=RPT_TABLE_RESOLUTION, delta_resolution=DELTA_TABLE_RESOLUTION):
+    """
+    Get the subjective weighting of the probability of a flood for each scenario from the shared quantized lookup table.
+    Values of delta outside [DELTA_TABLE_MIN, DELTA_TABLE_MAX] are clipped to the range.
+
+    Parameters:
+    - flood_risk: Tuple with the probability of a flood for each scenario
+    - RPt: Risk perception at time t, between 0 and 1
+    - delta: Fixed delta parameter of the household
+    - rpt_resolution: Number of intervals the risk perception range [0, 1] is divided into
+    - delta_resolution: Number of intervals the delta range is divided into
+
+    Returns:
+    - Subjective weighting of the probability for each scenario
+    """
+    rpt_index = int(round(min(max(RPt, 0), 1) * rpt_resolution))
+    delta_fraction = (delta - DELTA_TABLE_MIN) / (DELTA_TABLE_MAX - DELTA_TABLE_MIN)
+    delta_index = int(round(min(max(delta_fraction, 0), 1) * delta_resolution))
+    return subjective_weighting_table(flood_risk, rpt_resolution, delta_resolution)[delta_index, rpt_index]
+
+
+# Per-household update rules, shared by Households and the parallel stepper (parallel.py).
+# They take any object with the household attributes, so both paths step households in exactly the same way.
+
+def household_risk_perception(household, neighbor_risk_perceptions, I_media, flood_occurs):
+    """
+    Return the risk perception of a household for this step.
+
+    Parameters:
+    - household: household (or household state) with the current risk perception RPt
+    - neighbor_risk_perceptions: risk perceptions of the neighbors of the household
+    - I_media: Media influence
+    - flood_occurs: Boolean variable indicating whether a flood occurs or not
+
+    Returns:
+    - RPt: Updated risk perception
+    """
+    if len(neighbor_risk_perceptions) > 0:
+        I_social = np.mean(neighbor_risk_perceptions) # the social influence is the average risk perception of the neighbors
+    else:
+        I_social = 1 # according to Haer et al. (2017) the social influence is considered 1.0 if its closest to their own risk perception, i.e., no social influence
     
-    return -lambda_val * (-x) ** theta
+    return risk_perception_bayesian_PT(RPt_1=household.RPt, I_social=I_social, I_media=I_media, flood_occurs=flood_occurs)
+
+def update_expected_utility_memoized(household, subsidie):
+    """
+    Add the expected utilities of this step using the household's persistent prospect theory parameters.
+    The utility of each (scenario, damage) pair is computed once and memoized on the household, the subjective
+    weighting of the flood probabilities is taken from the shared lookup table.
+
+    Parameters:
+    - household: household (or household state) with persistent delta, lambda_val and theta
+    - subsidie: Subsidy for adaptation measure
+    """
+    # (Re)compute the memoized utilities only if they do not exist yet or the subsidy level changed
+    if household.utilities_subsidie != subsidie:
+        household.utilities_measure, household.utilities_nomeasure = outcome_utilities_prospect_theory(flood_damage_list=household.flood_damage_estimated_list,
+                                                                                                       cost_of_measure=household.cost_measure,
+                                                                                                       subsidie=subsidie,
+                                                                                                       lambda_val=household.lambda_val,
+                                                                                                       theta=household.theta
+                                                                                                       )
+        household.utilities_subsidie = subsidie
+    
+    pi_i = lookup_subjective_weighting(flood_risk=tuple(household.flood_risk), RPt=household.RPt, delta=household.delta)
+    household.expected_utility_measure += float(np.dot(pi_i, household.utilities_measure))
+    household.expected_utility_nomeasure += float(np.dot(pi_i, household.utilities_nomeasure))
+
+def household_adaptation_decision(household, subsidie, step, savings_factor):
+    """
+    Decide on adaptation based on the expected utilities and the savings of the household, and update its savings.
+
+    Parameters:
+    - household: household (or household state) with updated expected utilities
+    - subsidie: Subsidy for adaptation measure
+    - step: current step of the model
+    - savings_factor: random factor between 0.95 and 1.05 the savings are multiplied with
+    """
+    # Logic for adaptation based on estimated flood damage and a random chance.
+    # These conditions are examples and should be refined for real-world applications.
+    if household.expected_utility_measure > household.expected_utility_nomeasure and household.savings > (household.cost_measure - subsidie + household.savings_threshold):
+        household.is_adapted = True  # Agent adapts to flooding
+        household.savings = household.savings - household.cost_measure  # Agent pays for adaptation measures
+        household.adapted_at_t = step  # Set the time step at which the agent adapts
+    
+    # Multiply the savings with a random factor to simulate savings and expenses of the household
+    household.savings = household.savings * savings_factor
 
 
 def load_flood_map(flood_map_choice):
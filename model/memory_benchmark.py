@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the household representation.
+
+Builds the same model once with the regular Households and once with CompactHouseholds
+and reports the number of bytes per household. Run from the model directory:
+
+    python memory_benchmark.py [number_of_households]
+"""
+import sys
+import numpy as np
+from mesa import Model
+
+from model import AdaptationModel
+
+
+def deep_size(obj, seen):
+    """
+    Recursively sum the size of an object and everything it references.
+    Objects in seen are not counted again, so objects shared between households are only counted once.
+    The model and classes are skipped since they are not part of a single household.
+    """
+    if id(obj) in seen or isinstance(obj, (Model, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        # a view does not own its data, count the array it is a view of
+        if obj.base is not None:
+            size += deep_size(obj.base, seen)
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def bytes_per_household(model):
+    """Return the average number of bytes per household, including its share of the model-level household arrays."""
+    seen = set()
+    households = [agent for agent in model.schedule.agents]
+    total = sum(deep_size(agent, seen) for agent in households)
+    if model.compact_households:
+        # the list attributes of compact households are views on these arrays, their data is counted here
+        for array in (model.household_coordinates, model.household_flood_depths, model.household_flood_damages):
+            total += deep_size(array, seen)
+    return total / len(households)
+
+
+def instance_dict_per_household(model):
+    """
+    Return the attribute names and average number of bytes of the instance __dict__ of the households.
+    CompactHouseholds keep a __dict__ since the Mesa Agent base class has no __slots__: it holds the attributes
+    set by Mesa (unique_id, model, pos) and any additional attributes from the input data (set_additional_attributes).
+    """
+    households = [agent for agent in model.schedule.agents]
+    names = sorted(set().union(*(agent.__dict__ for agent in households)))
+    seen = set()
+    total = sum(deep_size(agent.__dict__, seen) for agent in households)
+    return names, total / len(households)
+
+
+if __name__ == "__main__":
+    number_of_households = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    results = {}
+    instance_dicts = {}
+    for compact_households in [False, True]:
+        model = AdaptationModel(seed=123, number_of_households=number_of_households, network='no_network',
+                                compact_households=compact_households)
+        results[compact_households] = bytes_per_household(model)
+        instance_dicts[compact_households] = instance_dict_per_household(model)
+
+    print(f"Households:        {results[False]:8.0f} bytes per household")
+    print(f"CompactHouseholds: {results[True]:8.0f} bytes per household")
+    print(f"Reduction:         {1 - results[True] / results[False]:8.1%}")
+    names, size = instance_dicts[True]
+    print(f"CompactHouseholds instance __dict__: {size:.0f} bytes per household, attributes: {', '.join(names)}")
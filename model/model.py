@@ -1,21 +1,35 @@
 # Importing necessary libraries
 import networkx as nx
 from mesa import Model, Agent
-from mesa.time import RandomActivation
+from mesa.time import RandomActivation, SimultaneousActivation
 from mesa.space import NetworkGrid
 from mesa.datacollection import DataCollector
 import geopandas as gpd
 import rasterio as rs
 import matplotlib.pyplot as plt
+import numpy as np
 import random
+import pandas as pd
 
 # Import the agent class(es) from agents.py
 from agents import Households
+from agents import CompactHouseholds
 from agents import Government
 
+# Import the online aggregate reporter from reporters.py
+from reporters import AggregateReporter
+
+# Import the parallel household stepper from parallel.py
+from parallel import ParallelHouseholdStepper
+
+# Import the population loader from population.py
+from population import load_population
+
 # Import functions from functions.py
-from functions import get_flood_map_data, calculate_basic_flood_damage, calculate_adapted_flood_damage, get_flood_depth, load_flood_map
+from functions import get_flood_map_data, load_flood_map
 from functions import map_domain_gdf, floodplain_gdf
+from functions import build_household_population, build_household_locations, draw_savings_factors
+from functions import calculate_basic_flood_damage_array, calculate_adapted_flood_damage_array
 
 
 # Define the AdaptationModel class
@@ -30,6 +44,9 @@ class AdaptationModel(Model):
                  number_of_households = 25, # number of household agents
                  # Simplified argument for choosing flood map. Can currently be "harvey", "100yr", or "500yr".
                  flood_map_choice='harvey',
+                 # Flood map choices to compare on the same population in one run, e.g. ["100yr", "500yr", "harvey"].
+                 # The flood shock is resolved for each of them at the time of flooding (see resolve_flood_scenarios)
+                 scenario_flood_map_choices = None,
                  # ### network related parameters ###
                  # The social network structure that is used.
                  # Can currently be "erdos_renyi", "barabasi_albert", "watts_strogatz", or "no_network"
@@ -48,16 +65,61 @@ class AdaptationModel(Model):
                  subsidie_level = 0.0,
                  # information bias of the government
                  information_bias = 0.0,
+                 # ### household related parameters ###
+                 # draw the prospect theory parameters once per household and memoize the utilities
+                 persistent_behavioural_parameters = False,
+                 # use the memory-compact household representation (CompactHouseholds)
+                 compact_households = False,
+                 # draw the initial household attributes for the whole population at once (see build_household_population)
+                 vectorized_population = False,
+                 # dataframe with the distribution of additional household parameters and the names of these parameters
+                 population_input_data = None,
+                 population_parameters = (),
+                 # directory of a population generated with population.generate_population. If given, the households
+                 # are loaded from it as CompactHouseholds and number_of_households is the size of the population
+                 population_file = None,
+                 # ### activation parameters ###
+                 # all households read the risk perception of the previous step (SimultaneousActivation) instead of RandomActivation
+                 synchronous_activation = False,
+                 # number of worker processes to step the households on, each stepping one partition of the network.
+                 # Requires synchronous_activation and persistent_behavioural_parameters, None steps the households in this process
+                 number_of_workers = None,
+                 # ### data collection parameters ###
+                 # collect one row per household per step with the DataCollector
+                 collect_agent_data = True,
+                 # keep running aggregates per household group during the run (see reporters.py)
+                 online_aggregates = False,
                  ):
         
         super().__init__(seed = seed)
         
+        # a generated population determines the number of households and is memory-mapped by compact households
+        if population_file is not None:
+            generated_population, population_metadata = load_population(population_file)
+            number_of_households = population_metadata['number_of_households']
+            compact_households = True
+        
         # defining the variables and setting the values
         self.number_of_households = number_of_households  # Total number of household agents
         self.seed = seed
         
         self.running = True  # Variable to control the simulation run
 
+        # households keep their prospect theory parameters for the whole run if True
+        self.persistent_behavioural_parameters = persistent_behavioural_parameters
+        self.compact_households = compact_households
+
+        # activation
+        self.synchronous_activation = synchronous_activation
+        if number_of_workers is not None and not (synchronous_activation and persistent_behavioural_parameters):
+            raise ValueError("Parallel stepping (number_of_workers) requires synchronous_activation and persistent_behavioural_parameters.")
+        if number_of_workers is not None and collect_agent_data:
+            raise ValueError("Parallel stepping (number_of_workers) requires collect_agent_data=False, "
+                             "use online_aggregates to analyse the households instead.")
+        if synchronous_activation:
+            # seed of the per step random numbers of the households, independent of the activation order
+            self.step_seed = self.random.getrandbits(64)
+
         # network
         self.network = network # Type of network to be created
         self.probability_of_network_connection = probability_of_network_connection
@@ -75,8 +137,20 @@ class AdaptationModel(Model):
         # Initialize maps
         self.initialize_maps(flood_map_choice)
 
+        # Flood map choices that share this population, in scenario mode
+        if scenario_flood_map_choices is not None:
+            for choice in scenario_flood_map_choices:
+                if choice not in self.estimated_flood_map_choices:
+                    raise ValueError(f"Unknown flood map choice: '{choice}'. "
+                                     f"Currently implemented choices are: {self.estimated_flood_map_choices}")
+            scenario_flood_map_choices = list(scenario_flood_map_choices)
+        self.scenario_flood_map_choices = scenario_flood_map_choices
+
         # set schedule for agents
-        self.schedule = RandomActivation(self)  # Schedule for activating agents
+        if self.synchronous_activation:
+            self.schedule = SimultaneousActivation(self)  # households step on the previous state and advance together
+        else:
+            self.schedule = RandomActivation(self)  # Schedule for activating agents
         
         # Create a Government agent and assign it to an attribute
         self.government = Government(unique_id=50, model=self, subsidie_level=subsidie_level, information_bias=information_bias)
@@ -84,10 +158,52 @@ class AdaptationModel(Model):
         # Define the savings levels
         savings_levels = [(0, 20000), (20000, 70000), (70000, 250000)]
 
+        # Compact households store their coordinates and flood depths in model-level arrays,
+        # for a generated population these are the memory-mapped columns of the population file
+        if population_file is not None:
+            self.household_coordinates = generated_population['coordinates']
+            self.household_flood_depths = generated_population['flood_depth']
+            self.household_flood_damages = generated_population['flood_damage']
+        elif self.compact_households:
+            self.allocate_household_arrays()
+
+        # Draw the initial attributes of all households at once, seeded from the model's random number generator
+        population = None
+        if population_file is not None:
+            population = {
+                'income_category': np.asarray(population_metadata['income_categories'], dtype=object)[generated_population['income_category']],
+                'savings': generated_population['savings'],
+                'RPt': generated_population['RPt'],
+                'in_floodplain': generated_population['in_floodplain'],
+            }
+        elif vectorized_population:
+            rng = np.random.default_rng(self.random.getrandbits(64))
+            population = build_household_population(number_of_households=self.G.number_of_nodes(),
+                                                    rng=rng,
+                                                    input_data=population_input_data,
+                                                    parameters=population_parameters,
+                                                    income_categories=Households.income_categories,
+                                                    income_weights=Households.income_weights,
+                                                    savings_levels=savings_levels)
+            # The locations and estimated flood depths are drawn at once as well, with each flood map loaded once
+            if not self.compact_households:
+                self.load_household_flood_maps()
+            population.update(build_household_locations(number_of_households=self.G.number_of_nodes(),
+                                                         rng=rng,
+                                                         flood_maps=list(self.household_flood_maps.values())))
+            if self.compact_households:
+                self.household_coordinates[:] = population['coordinates']
+                self.household_flood_depths[:] = population['flood_depth']
+                self.household_flood_damages[:] = calculate_basic_flood_damage_array(population['flood_depth'])
+
         # Create households through initiating a household on each node of the network graph
         for i, node in enumerate(self.G.nodes()):
-            # Pass the entire savings_levels list to the Household
-            household = Households(unique_id=i, model=self, savings_range=savings_levels)
+            attributes = {name: values[i] for name, values in population.items()} if population is not None else None
+            if self.compact_households:
+                household = CompactHouseholds(unique_id=i, model=self, row=i, savings_range=savings_levels, attributes=attributes)
+            else:
+                # Pass the entire savings_levels list to the Household
+                household = Households(unique_id=i, model=self, savings_range=savings_levels, attributes=attributes)
             
             # Add the household to the schedule and place it on the grid
             self.schedule.add(household)
@@ -96,6 +212,18 @@ class AdaptationModel(Model):
         # Define when flood occurs (in steps)
         self.flood_occurs = time_of_flooding
 
+        # set up the online aggregate reporter, with parallel stepping each worker collects the aggregates of its partition
+        self._aggregates = AggregateReporter() if online_aggregates else None
+
+        # Step the households on worker processes, one per partition of the social network
+        self.stepper = ParallelHouseholdStepper(self, number_of_workers, aggregates=self._aggregates) if number_of_workers is not None else None
+
+        # Actual flood depth and damage of each household for each scenario, indexed by unique_id
+        if self.scenario_flood_map_choices is not None:
+            number_of_nodes = self.G.number_of_nodes()
+            self.scenario_flood_depth_actual = {choice: np.zeros(number_of_nodes) for choice in self.scenario_flood_map_choices}
+            self.scenario_flood_damage_actual = {choice: np.zeros(number_of_nodes) for choice in self.scenario_flood_map_choices}
+
         # Data collection setup to collect data
         model_metrics = {
             "Total_adapted_households": self.total_adapted_households,
@@ -121,6 +249,17 @@ class AdaptationModel(Model):
                         # ... other reporters ...
                         }
             
+        # in scenario mode the actual flood depth and damage are collected for each scenario
+        if self.scenario_flood_map_choices is not None:
+            for choice in self.scenario_flood_map_choices:
+                agent_metrics[f"FloodDepthActual_{choice}"] = lambda a, choice=choice: a.model.scenario_flood_depth_actual[choice][a.unique_id]
+                agent_metrics[f"FloodDamageActual_{choice}"] = lambda a, choice=choice: a.model.scenario_flood_damage_actual[choice][a.unique_id]
+
+        # agent-level data is not needed when the analysis is done with the online aggregates
+        self.collect_agent_data = collect_agent_data
+        if not collect_agent_data:
+            agent_metrics = {}
+
         #set up the data collector 
         self.datacollector = DataCollector(
             model_reporters=model_metrics, 
@@ -179,8 +318,117 @@ class AdaptationModel(Model):
         self.band_flood_img, self.bound_left, self.bound_right, self.bound_top, self.bound_bottom = get_flood_map_data(
             self.flood_map)
 
+    def allocate_household_arrays(self):
+        """
+        Allocate the model-level arrays that back the coordinates and estimated flood depths and damages of CompactHouseholds.
+        The flood maps used for the estimation are loaded once here instead of once per household.
+        """
+        number_of_nodes = self.G.number_of_nodes()
+        # x and y coordinate of each household
+        self.household_coordinates = np.zeros((number_of_nodes, 2))
+        # one column per flood map ('harvey', '100yr', '500yr') and a last column of 0 for the case of no flooding
+        self.household_flood_depths = np.zeros((number_of_nodes, 4))
+        self.household_flood_damages = np.zeros((number_of_nodes, 4))
+        self.load_household_flood_maps()
+
+    def load_household_flood_maps(self):
+        """Load each flood map used for the estimated flood depths of the households once, with its band."""
+        self.household_flood_maps = {}
+        for choice in ['harvey', '100yr', '500yr']:
+            flood_map = load_flood_map(choice)
+            self.household_flood_maps[choice] = (flood_map, flood_map.read(1))
+
+    # Order of the flood maps in the flood_depth_estimated_list and flood_damage_estimated_list of the households
+    estimated_flood_map_choices = ['harvey', '100yr', '500yr']
+
+    def actual_flood(self, flood_map_choice):
+        """
+        Return the households with their actual flood depth and damage if the flood of the given flood map choice occurs.
+        The actual flood depth is the depth each household already sampled for that flood map (flood_depth_estimated_list),
+        so no flood map has to be loaded, and the damages of all households are calculated at once.
+        Compact households read their depths straight from the model-level arrays (memory-mapped for a population_file).
+        """
+        column = self.estimated_flood_map_choices.index(flood_map_choice)
+        households = [agent for agent in self.schedule.agents if isinstance(agent, Households)]
+        if self.compact_households:
+            rows = np.fromiter((agent.row for agent in households), dtype=np.int64, count=len(households))
+            flood_depth = np.asarray(self.household_flood_depths[rows, column], dtype=float)
+        else:
+            flood_depth = np.fromiter((agent.flood_depth_estimated_list[column] for agent in households), dtype=float, count=len(households))
+        is_adapted = np.fromiter((agent.is_adapted for agent in households), dtype=bool, count=len(households))
+        # Negative depths are already set to 0, the damage depends on whether the household has adapted
+        flood_damage = np.where(is_adapted, calculate_adapted_flood_damage_array(flood_depth), calculate_basic_flood_damage_array(flood_depth))
+        return households, flood_depth, flood_damage
+
+    def resolve_flood_scenarios(self):
+        """
+        Resolve the flood shock for each of the scenario flood map choices on the shared population, see actual_flood.
+        The values of the model's own flood_map_choice are also set on the households.
+        """
+        for choice in self.scenario_flood_map_choices:
+            households, flood_depth, flood_damage = self.actual_flood(choice)
+            unique_ids = [agent.unique_id for agent in households]
+            self.scenario_flood_depth_actual[choice][unique_ids] = flood_depth
+            self.scenario_flood_damage_actual[choice][unique_ids] = flood_damage
+            if choice == self.flood_map_choice:
+                for agent, depth, damage in zip(households, flood_depth.tolist(), flood_damage.tolist()):
+                    agent.flood_depth_actual = depth
+                    agent.flood_damage_actual = damage
+
+    def scenario_results(self):
+        """
+        Return the collected data of a scenario mode run per scenario, in the format of a separate run per flood map choice:
+        one row per step and household with the model and agent reporters and a flood_map_choice column.
+        The FloodDepthActual and FloodDamageActual columns hold the values of the scenario.
+        """
+        if self.scenario_flood_map_choices is None:
+            raise ValueError("scenario_results is only available for models with scenario_flood_map_choices.")
+        if not self.collect_agent_data:
+            raise ValueError("scenario_results requires collect_agent_data=True, "
+                             "use the aggregates per scenario of model.aggregates (online_aggregates=True) instead.")
+        model_data = self.datacollector.get_model_vars_dataframe()
+        model_data.index.name = 'Step'
+        agent_data = self.datacollector.get_agent_vars_dataframe().reset_index()
+        scenario_columns = [f"{name}_{choice}" for choice in self.scenario_flood_map_choices
+                            for name in ("FloodDepthActual", "FloodDamageActual")]
+        shared_data = agent_data.drop(columns=scenario_columns + ["FloodDepthActual", "FloodDamageActual"])
+        shared_data = shared_data.merge(model_data, left_on='Step', right_index=True)
+
+        results = []
+        for choice in self.scenario_flood_map_choices:
+            scenario_data = shared_data.copy()
+            scenario_data["FloodDepthActual"] = agent_data[f"FloodDepthActual_{choice}"].to_numpy()
+            scenario_data["FloodDamageActual"] = agent_data[f"FloodDamageActual_{choice}"].to_numpy()
+            scenario_data["flood_map_choice"] = choice
+            results.append(scenario_data)
+        return pd.concat(results, ignore_index=True)
+
+    @property
+    def aggregates(self):
+        """
+        The online aggregate reporter of the run (online_aggregates=True), None otherwise.
+        While stepping in parallel, the reporters of the workers are merged on each access.
+        """
+        if self.stepper is not None and self._aggregates is not None and not self.stepper.closed:
+            return self.stepper.merged_aggregates()
+        return self._aggregates
+
+    def close(self):
+        """
+        Finish a run with parallel stepping: copy the final state of the households to the agents,
+        merge the online aggregates of the workers and stop the worker processes.
+        Models that are not closed stop their workers when they are garbage collected or the interpreter exits.
+        """
+        if self.stepper is not None and not self.stepper.closed:
+            self.stepper.pull_state()
+            if self._aggregates is not None:
+                self._aggregates = self.stepper.merged_aggregates()
+            self.stepper.close()
+
     def total_adapted_households(self):
         """Return the total number of households that have adapted."""
+        if self.stepper is not None:
+            return self.stepper.total_adapted_households
         #BE CAREFUL THAT YOU MAY HAVE DIFFERENT AGENT TYPES SO YOU NEED TO FIRST CHECK IF THE AGENT IS ACTUALLY A HOUSEHOLD AGENT USING "ISINSTANCE"
         adapted_count = sum([1 for agent in self.schedule.agents if isinstance(agent, Households) and agent.is_adapted])
         return adapted_count
@@ -222,26 +470,38 @@ class AdaptationModel(Model):
         # Update the government's spendings
         self.government.step()
         
-        if self.schedule.steps == self.flood_occurs:
-            for agent in self.schedule.agents:
-                # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
-                # agent.flood_depth_actual = random.uniform(0.5, 1.2) * agent.flood_depth_estimated
-                
-                # Calculate the actual flood depth based on the flood map
-                agent.flood_depth_actual = get_flood_depth(corresponding_map=load_flood_map(self.flood_map_choice), location=agent.location, band=self.band_flood_img)
-                # Flood depth can be negative if the location is at a high elevation
-                # handle negative values of flood depth
-                if agent.flood_depth_actual < 0:
-                    agent.flood_depth_actual = 0
-                    
-                # IF statement to calculate flood damage depending on adaptation measures taken or not
-                if agent.is_adapted:
-                    # calculate the flood damage given the actual flood depth if household is adapted
-                    agent.flood_damage_actual = calculate_adapted_flood_damage(agent.flood_depth_actual)
-                else:
-                    # calculate the flood damage given the actual flood depth if household is not adapted
-                    agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual)
+        # The flood shock needs the current adaptation status of the households from the workers
+        if self.stepper is not None and self.schedule.steps == self.flood_occurs:
+            self.stepper.pull_state(['is_adapted'])
+        
+        if self.schedule.steps == self.flood_occurs and self.scenario_flood_map_choices is not None:
+            # Scenario mode: the pre-flood trajectory is shared, only the flood shock is resolved per flood map choice
+            self.resolve_flood_scenarios()
+        elif self.schedule.steps == self.flood_occurs:
+            # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
+            # agent.flood_depth_actual = random.uniform(0.5, 1.2) * agent.flood_depth_estimated
+            
+            # The actual flood depth is the depth the household sampled from the flood map of this run, the same rule as
+            # in scenario mode. The flood damage depends on whether the household has adapted (see actual_flood)
+            households, flood_depth, flood_damage = self.actual_flood(self.flood_map_choice)
+            for agent, depth, damage in zip(households, flood_depth.tolist(), flood_damage.tolist()):
+                agent.flood_depth_actual = depth
+                agent.flood_damage_actual = damage
+        
+        # The workers keep the actual flood depths and damages for the online aggregates of their partition
+        if self.stepper is not None and self.stepper.collects_aggregates and self.schedule.steps == self.flood_occurs:
+            self.stepper.push_flood()
         
         # Collect data and advance the model by one step
         self.datacollector.collect(self)
-        self.schedule.step()
+        if self._aggregates is not None and self.stepper is None:
+            self._aggregates.collect(self)
+        
+        if self.stepper is not None:
+            # the workers collect the online aggregates of this step before stepping their households
+            self.stepper.step()
+        else:
+            if self.synchronous_activation:
+                # random factors of the household savings for this step, indexed by unique_id
+                self.savings_factors = draw_savings_factors(self.step_seed, self.schedule.steps, np.arange(self.G.number_of_nodes()))
+            self.schedule.step()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel stepping of the households of the Flood Adaptation Model.
+
+The social network is partitioned into balanced subgraphs with few edges between them. Each partition
+is stepped by its own worker process, which keeps the state of its households between steps. After each
+step only the risk perception of households with neighbors in other partitions is exchanged.
+Households are stepped synchronously (every household reads the risk perception of the previous step),
+so the results do not depend on the number of workers.
+With online aggregates, each worker keeps an AggregateReporter of its own partition, which are merged in the model.
+The state of all households is only exchanged at the time of flooding and when the model is closed.
+"""
+import multiprocessing as mp
+import weakref
+import numpy as np
+import networkx as nx
+
+from functions import household_risk_perception, update_expected_utility_memoized, household_adaptation_decision, draw_savings_factors
+from reporters import AggregateReporter
+
+
+def partition_network(G, number_of_partitions, seed=None):
+    """
+    Partition the network into balanced subgraphs with a low number of edges between them, by recursive bisection.
+    Each bisection splits the nodes in proportion to the number of partitions on either side (ceil(k/2) : floor(k/2)),
+    so the partitions differ by at most one node in size for any number of partitions.
+    The initial split follows a breadth-first ordering of the nodes and is refined with the Kernighan-Lin algorithm,
+    which swaps pairs of nodes and therefore keeps the sizes of both sides.
+
+    Parameters
+    ----------
+    G: networkx graph
+    number_of_partitions: number of partitions
+    seed: seed for the Kernighan-Lin bisection
+
+    Returns
+    -------
+    partitions: list of sets of nodes
+    """
+    number_of_partitions = min(number_of_partitions, G.number_of_nodes())
+    if number_of_partitions <= 1:
+        return [set(G.nodes())]
+
+    # breadth-first ordering of the nodes, so the initial split consists of connected regions where possible
+    order = []
+    visited = set()
+    for start in sorted(G.nodes()):
+        if start not in visited:
+            component = [start] + [node for _, node in nx.bfs_edges(G, start)]
+            visited.update(component)
+            order.extend(component)
+
+    partitions_left = (number_of_partitions + 1) // 2
+    size_left = round(len(order) * partitions_left / number_of_partitions)
+    left, right = nx.community.kernighan_lin_bisection(G, partition=(set(order[:size_left]), set(order[size_left:])), seed=seed)
+    # the sides are not returned in a fixed order, but keep their sizes
+    if len(left) != size_left:
+        left, right = right, left
+    return (partition_network(G.subgraph(left), partitions_left, seed=seed)
+            + partition_network(G.subgraph(right), number_of_partitions - partitions_left, seed=seed))
+
+
+class HouseholdState:
+    """
+    Plain state of a household in a worker process, with the attributes the shared update rules in functions.py
+    (household_risk_perception, update_expected_utility_memoized, household_adaptation_decision) read and write
+    and the attributes the online aggregates read (see AggregateReporter).
+    """
+
+    __slots__ = ('unique_id', 'neighbors', 'RPt', 'RPt_1', 'savings', 'is_adapted', 'adapted_at_t',
+                 'expected_utility_measure', 'expected_utility_nomeasure', 'utilities_measure', 'utilities_nomeasure', 'utilities_subsidie',
+                 'delta', 'lambda_val', 'theta', 'flood_damage_estimated_list', 'flood_risk', 'cost_measure', 'savings_threshold',
+                 'income_category', 'in_floodplain', 'flood_depth_actual', 'flood_damage_actual')
+
+    def __init__(self, agent, neighbors):
+        self.unique_id = agent.unique_id
+        self.neighbors = neighbors
+        for name in self.__slots__[2:]:
+            setattr(self, name, getattr(agent, name))
+        self.flood_damage_estimated_list = list(agent.flood_damage_estimated_list)
+        self.flood_risk = tuple(agent.flood_risk)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _step_partition(households, risk_perceptions, step, I_media, subsidie, flood_occurs, savings_factors):
+    """
+    Synchronous step of the households of one partition, equal to Households.step and Households.advance
+    since both use the same update rules from functions.py. savings_factors holds the factor of each household, in order.
+    """
+    # all new risk perceptions are computed from the risk perceptions of the previous step
+    new_risk_perceptions = [household_risk_perception(household, [risk_perceptions[neighbor] for neighbor in household.neighbors], I_media=I_media, flood_occurs=flood_occurs)
+                            for household in households]
+
+    for household, new_risk_perception, savings_factor in zip(households, new_risk_perceptions, savings_factors):
+        household.RPt_1 = household.RPt
+        household.RPt = new_risk_perception
+        risk_perceptions[household.unique_id] = household.RPt
+        update_expected_utility_memoized(household, subsidie=subsidie)
+        household_adaptation_decision(household, subsidie=subsidie, step=step, savings_factor=savings_factor)
+
+
+def _partition_worker(connection, households, risk_perceptions, boundary, step_seed, aggregates):
+    """
+    Worker process that keeps the state of the households of one partition and steps them on request.
+    risk_perceptions holds the risk perception of the local households and of their neighbors in other partitions.
+    aggregates is None or the reporter to collect the online aggregates of the partition in, the scenarios and
+    the variables that differ between the scenarios.
+    """
+    unique_ids = [household.unique_id for household in households]
+    reporter = None
+    if aggregates is not None:
+        reporter, scenarios, scenario_variables = aggregates
+        # values of the scenario specific variables aligned with the households, 0 until the time of flooding
+        scenario_values = {variable: {scenario: np.zeros(len(households)) for scenario in scenarios} for variable in scenario_variables}
+    while True:
+        message = connection.recv()
+        if message[0] == 'close':
+            break
+        if message[0] == 'aggregates':
+            connection.send(reporter)
+            continue
+        if message[0] == 'flood':
+            # actual flood depth and damage resolved by the model, aligned with the households
+            _, actual_values, actual_scenario_values = message
+            for name, values in actual_values.items():
+                for household, value in zip(households, values):
+                    setattr(household, name, value)
+            if reporter is not None:
+                scenario_values.update(actual_scenario_values)
+            continue
+        if message[0] == 'state':
+            # send only the requested attributes, not the whole household state
+            attributes = message[1]
+            connection.send((unique_ids,
+                             {name: [getattr(household, name) for household in households] for name in attributes}))
+            continue
+        _, step, I_media, subsidie, flood_occurs, boundary_updates = message
+        if reporter is not None:
+            # the aggregates of this step are collected before the households are stepped, as in the model
+            reporter.collect_households(households, step, scenarios, scenario_values)
+        risk_perceptions.update(boundary_updates)
+        # only the factors of the households of this partition, keyed by their unique_id
+        savings_factors = draw_savings_factors(step_seed, step, unique_ids)
+        _step_partition(households, risk_perceptions, step, I_media, subsidie, flood_occurs, savings_factors)
+        # send back only the risk perception of households that are neighbors of other partitions
+        connection.send(({unique_id: risk_perceptions[unique_id] for unique_id in boundary},
+                         sum(1 for household in households if household.is_adapted)))
+    connection.close()
+
+
+def _close_workers(connections, workers):
+    """Stop the worker processes, used as finalizer of the model so no workers outlive it."""
+    for connection in connections:
+        try:
+            connection.send(('close',))
+            connection.close()
+        except (OSError, EOFError):
+            pass  # the worker is already gone
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+
+
+class ParallelHouseholdStepper:
+    """
+    Steps the households of a model on a pool of worker processes, one per partition of the social network.
+    Requires synchronous activation and persistent prospect theory parameters, see AdaptationModel.
+
+    The state of the households lives in the workers while the model runs. pull_state copies the requested
+    attributes back to the Mesa agents, which the model does for the attributes the flood shock needs and when it is closed.
+    Per-agent data collection is not supported while stepping in parallel. Online aggregates are collected by
+    each worker for its own partition, with the same replicate_id, and merged with merged_aggregates.
+    """
+
+    # Household attributes that are stepped by the workers
+    stepped_attributes = ('RPt', 'RPt_1', 'savings', 'is_adapted', 'adapted_at_t', 'expected_utility_measure', 'expected_utility_nomeasure',
+                          'utilities_measure', 'utilities_nomeasure', 'utilities_subsidie')
+
+    def __init__(self, model, number_of_workers, aggregates=None):
+        """
+        aggregates: optional (empty) AggregateReporter of the model, of which each worker collects a copy
+        """
+        self.model = model
+        self.agents = {agent.unique_id: agent for agent in model.schedule.agents}
+
+        # partition the social network and map the nodes to the households on them
+        partitions = partition_network(model.G, number_of_workers, seed=model.step_seed % 2**32)
+        partition_of = {}
+        unique_ids = []
+        for index, nodes in enumerate(partitions):
+            ids = [agent.unique_id for node in sorted(nodes) for agent in model.grid.get_cell_list_contents([node])]
+            unique_ids.append(ids)
+            partition_of.update({unique_id: index for unique_id in ids})
+
+        # for each partition, the households in other partitions whose risk perception it needs
+        neighbors = {unique_id: [neighbor.unique_id for neighbor in model.grid.get_neighbors(agent.pos)] for unique_id, agent in self.agents.items()}
+        self.ghosts = [set() for _ in partitions]
+        for unique_id, household_neighbors in neighbors.items():
+            for neighbor in household_neighbors:
+                if partition_of[neighbor] != partition_of[unique_id]:
+                    self.ghosts[partition_of[unique_id]].add(neighbor)
+        self.partition_of = partition_of
+        self.unique_ids = unique_ids
+
+        # the workers collect the online aggregates of their partition, all copies share the replicate_id of the model's reporter
+        worker_aggregates = None
+        if aggregates is not None:
+            unsupported = aggregates.household_attributes - set(HouseholdState.__slots__)
+            if unsupported:
+                raise ValueError(f"Online aggregates of {sorted(unsupported)} are not supported with parallel stepping, "
+                                 f"the workers only keep the household attributes {HouseholdState.__slots__}.")
+            if model.scenario_flood_map_choices is not None:
+                worker_aggregates = (aggregates, list(model.scenario_flood_map_choices), ('flood_depth_actual', 'flood_damage_actual'))
+            else:
+                worker_aggregates = (aggregates, [model.flood_map_choice], ())
+        self.collects_aggregates = aggregates is not None
+
+        self.connections = []
+        self.workers = []
+        self.adapted_counts = [0] * len(partitions)
+        context = mp.get_context()
+        for index, ids in enumerate(unique_ids):
+            households = [HouseholdState(self.agents[unique_id], neighbors[unique_id]) for unique_id in ids]
+            risk_perceptions = {unique_id: self.agents[unique_id].RPt for unique_id in set(ids) | self.ghosts[index]}
+            boundary = [unique_id for unique_id in ids if any(partition_of[neighbor] != index for neighbor in neighbors[unique_id])]
+            self.adapted_counts[index] = sum(1 for household in households if household.is_adapted)
+
+            parent_connection, child_connection = context.Pipe()
+            worker = context.Process(target=_partition_worker,
+                                     args=(child_connection, households, risk_perceptions, boundary, model.step_seed, worker_aggregates),
+                                     daemon=True)
+            worker.start()
+            self.connections.append(parent_connection)
+            self.workers.append(worker)
+
+        self.boundary_updates = [{} for _ in partitions]
+        self.synced_attributes = set(self.stepped_attributes)  # attributes for which the Mesa agents hold the current state
+
+        # stop the workers when the model is garbage collected or the interpreter exits, if close was not called before
+        self._finalizer = weakref.finalize(model, _close_workers, self.connections, self.workers)
+
+    @property
+    def total_adapted_households(self):
+        """Total number of adapted households, as reported by the workers after the last step."""
+        return sum(self.adapted_counts)
+
+    def step(self):
+        """Step all partitions in parallel and exchange the risk perception of the boundary households."""
+        if self.closed:
+            raise RuntimeError("The workers of this model have been stopped (close), it cannot be stepped anymore.")
+        model = self.model
+        message = ('step', model.schedule.steps, model.government.information, model.government.subsidies, model.flood_occurs)
+        for connection, boundary_updates in zip(self.connections, self.boundary_updates):
+            connection.send(message + (boundary_updates,))
+
+        self.boundary_updates = [{} for _ in self.connections]
+        for index, connection in enumerate(self.connections):
+            boundary_risk_perceptions, self.adapted_counts[index] = connection.recv()
+            # route the boundary values to the partitions that have these households as neighbors
+            for partition, ghosts in enumerate(self.ghosts):
+                if partition != index:
+                    self.boundary_updates[partition].update({unique_id: value for unique_id, value in boundary_risk_perceptions.items() if unique_id in ghosts})
+
+        model.schedule.steps += 1
+        model.schedule.time += 1
+        self.synced_attributes.clear()
+
+    def pull_state(self, attributes=None):
+        """
+        Copy the current value of the given household attributes from the workers to the Mesa agents.
+        Attributes that are not stepped by the workers or already up to date are skipped, None pulls all stepped attributes.
+        """
+        if attributes is None:
+            attributes = self.stepped_attributes
+        attributes = [name for name in self.stepped_attributes if name in attributes and name not in self.synced_attributes]
+        if not attributes:
+            return
+        for connection in self.connections:
+            connection.send(('state', attributes))
+        for connection in self.connections:
+            unique_ids, values = connection.recv()
+            for name in attributes:
+                for unique_id, value in zip(unique_ids, values[name]):
+                    setattr(self.agents[unique_id], name, value)
+        self.synced_attributes.update(attributes)
+
+    def push_flood(self):
+        """
+        Send the actual flood depth and damage of the households, resolved by the model at the time of flooding,
+        to the workers, which keep them for their online aggregates.
+        """
+        model = self.model
+        for connection, unique_ids in zip(self.connections, self.unique_ids):
+            agents = [self.agents[unique_id] for unique_id in unique_ids]
+            actual_values = {name: [getattr(agent, name) for agent in agents] for name in ('flood_depth_actual', 'flood_damage_actual')}
+            scenario_values = {}
+            if model.scenario_flood_map_choices is not None:
+                scenario_values = {'flood_depth_actual': {choice: model.scenario_flood_depth_actual[choice][unique_ids] for choice in model.scenario_flood_map_choices},
+                                   'flood_damage_actual': {choice: model.scenario_flood_damage_actual[choice][unique_ids] for choice in model.scenario_flood_map_choices}}
+            connection.send(('flood', actual_values, scenario_values))
+
+    def merged_aggregates(self):
+        """Return the online aggregates of all workers merged into one reporter."""
+        for connection in self.connections:
+            connection.send(('aggregates',))
+        return AggregateReporter.merge_all([connection.recv() for connection in self.connections])
+
+    @property
+    def closed(self):
+        """Whether the worker processes have been stopped."""
+        return not self._finalizer.alive
+
+    def close(self):
+        """Stop the worker processes."""
+        self._finalizer()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming synthetic population generator for the Flood Adaptation Model.
+
+Generates households in fixed-size chunks and writes them to a directory with one .npy file per column,
+so populations far larger than the Houston sample (10^5 - 10^7 households) can be generated once,
+memory-mapped and reused across model runs. Load a population with AdaptationModel(population_file=path).
+
+Run from the model directory:
+
+    python population.py path number_of_households [seed]
+"""
+import os
+import sys
+import json
+import numpy as np
+
+from functions import load_flood_map, build_household_locations
+from functions import build_household_population, calculate_basic_flood_damage_array
+
+
+# Order of the flood maps in the flood depth and damage columns, as in flood_depth_estimated_list of the households.
+# A last column of 0 is added for the case of no flooding
+flood_map_choices = ['harvey', '100yr', '500yr']
+income_categories = ['low', 'middle', 'high']
+
+# Columns of the population file with their data type and number of values per household
+population_columns = {
+    'coordinates': (np.float64, 2),
+    'in_floodplain': (np.bool_, 1),
+    'income_category': (np.uint8, 1),  # index in income_categories
+    'savings': (np.int32, 1),
+    'RPt': (np.float64, 1),
+    'flood_depth': (np.float32, len(flood_map_choices) + 1),
+    'flood_damage': (np.float64, len(flood_map_choices) + 1),
+}
+
+
+def generate_population(path, number_of_households, chunk_size=100000, seed=None):
+    """
+    Generate a synthetic population chunk by chunk and write it to a directory of memory-mappable .npy files.
+    Only one chunk (and the flood map bands) is held in memory at a time.
+
+    Parameters
+    ----------
+    path: directory to write the population to
+    number_of_households: number of households to generate
+    chunk_size: number of households generated at once
+    seed: seed of the random number generator
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # The output columns are written directly into memory-mapped files
+    columns = {}
+    for name, (dtype, width) in population_columns.items():
+        shape = (number_of_households, width) if width > 1 else (number_of_households,)
+        columns[name] = np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode='w+', dtype=dtype, shape=shape)
+
+    # Load each flood map once
+    flood_maps = []
+    for choice in flood_map_choices:
+        flood_map = load_flood_map(choice)
+        flood_maps.append((flood_map, flood_map.read(1)))
+
+    for start in range(0, number_of_households, chunk_size):
+        stop = min(start + chunk_size, number_of_households)
+        size = stop - start
+
+        # Location within the model domain, whether it is within the floodplain and the estimated flood depth for each flood map
+        locations = build_household_locations(size, rng, flood_maps)
+        columns['coordinates'][start:stop] = locations['coordinates']
+        columns['in_floodplain'][start:stop] = locations['in_floodplain']
+        columns['flood_depth'][start:stop] = locations['flood_depth']
+        columns['flood_damage'][start:stop] = calculate_basic_flood_damage_array(columns['flood_depth'][start:stop])
+
+        # Income category, savings and initial risk perception
+        attributes = build_household_population(size, rng, income_categories=tuple(income_categories))
+        for index, category in enumerate(income_categories):
+            columns['income_category'][start:stop][attributes['income_category'] == category] = index
+        columns['savings'][start:stop] = attributes['savings']
+        columns['RPt'][start:stop] = attributes['RPt']
+
+    for column in columns.values():
+        column.flush()
+
+    metadata = {
+        'number_of_households': number_of_households,
+        'flood_map_choices': flood_map_choices,
+        'income_categories': income_categories,
+        'chunk_size': chunk_size,
+        'seed': seed,
+    }
+    with open(os.path.join(path, 'population.json'), 'w') as file:
+        json.dump(metadata, file, indent=4)
+
+
+def load_population(path, mmap_mode='r'):
+    """
+    Load a population generated with generate_population. The columns are memory-mapped, not read into memory.
+
+    Parameters
+    ----------
+    path: directory the population was written to
+    mmap_mode: memory-map mode passed to numpy.load
+
+    Returns
+    -------
+    population: dictionary with an array per column
+    metadata: dictionary with the number of households, flood map choices and income categories
+    """
+    with open(os.path.join(path, 'population.json')) as file:
+        metadata = json.load(file)
+    population = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in population_columns}
+    return population, metadata
+
+
+if __name__ == "__main__":
+    generate_population(path=sys.argv[1],
+                        number_of_households=int(sys.argv[2]),
+                        seed=int(sys.argv[3]) if len(sys.argv) > 3 else None)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Online aggregate reporters for the Flood Adaptation Model.
+
+Instead of collecting one row per agent per step and aggregating afterwards with pandas,
+the AggregateReporter keeps running aggregates (count, sum, mean, variance and fixed-bin histograms)
+per scenario, step and household group while the model runs. Reporters of different replicates
+or worker processes can be merged into one.
+"""
+import uuid
+import numpy as np
+import pandas as pd
+
+from agents import Households
+
+
+class RunningStatistic:
+    """
+    Running count, sum, mean and variance of a variable.
+    Batches are combined with the parallel algorithm of Chan et al. (1979), so statistics of
+    different replicates or workers can be merged without keeping the underlying values.
+    """
+
+    __slots__ = ('count', 'total', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+
+    def update(self, values):
+        """Add a batch of values to the statistic."""
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return
+        batch = RunningStatistic()
+        batch.count = values.size
+        batch.total = float(values.sum())
+        batch.mean = batch.total / batch.count
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        self.merge(batch)
+
+    def merge(self, other):
+        """Merge the statistic of another batch, replicate or worker into this one."""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        difference = other.mean - self.mean
+        self.m2 += other.m2 + difference ** 2 * self.count * other.count / count
+        self.mean += difference * other.count / count
+        self.total += other.total
+        self.count = count
+
+    @property
+    def variance(self):
+        """Sample variance (ddof=1, as pandas uses by default)."""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+
+class FixedBinHistogram:
+    """
+    Histogram with fixed bin edges. As in numpy.histogram, the bins are half-open [low, high) except the last,
+    which includes the upper edge. Values outside the edges are counted in the first or last bin.
+    """
+
+    __slots__ = ('bin_edges', 'counts')
+
+    def __init__(self, bin_edges):
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.counts = np.zeros(len(self.bin_edges) - 1, dtype=np.int64)
+
+    def update(self, values):
+        """Add a batch of values to the histogram."""
+        values = np.clip(np.asarray(values, dtype=float), self.bin_edges[0], self.bin_edges[-1])
+        self.counts += np.histogram(values, bins=self.bin_edges)[0]
+
+    def merge(self, other):
+        """Merge the counts of another histogram with the same bin edges into this one."""
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError("Histograms with different bin edges cannot be merged.")
+        self.counts += other.counts
+
+
+class AggregateReporter:
+    """
+    Keeps running aggregates of household variables during a model run.
+
+    The aggregates are grouped by scenario (flood map choice), step and household group, where
+    a group is the combination of income category, floodplain membership and adaptation status.
+    Marginal aggregates (e.g. per income category only) are obtained by merging groups afterwards,
+    see the marginal method.
+
+    Each reporter belongs to a replicate (model run), identified by replicate_id. Merged reporters keep the set
+    of replicate ids, so reporters of workers that each collected part of the households of the same run
+    must be created with the same replicate_id to be counted as one replicate.
+    """
+
+    # Household attributes that define a group
+    group_by = ('income_category', 'in_floodplain', 'is_adapted')
+
+    # Default variables for which count, sum, mean and variance are kept
+    default_variables = ('savings', 'RPt', 'flood_depth_actual', 'flood_damage_actual')
+
+    # Default variables for which a fixed-bin histogram is kept, with their bin edges
+    default_histograms = {
+        'RPt': np.linspace(0, 1, 11),
+        'flood_damage_actual': np.linspace(0, 100000, 11),  # flood damage is between 0 and 100000 USD
+    }
+
+    def __init__(self, variables=None, histograms=None, replicate_id=None):
+        self.variables = tuple(variables) if variables is not None else self.default_variables
+        self.histogram_edges = dict(histograms) if histograms is not None else dict(self.default_histograms)
+        self.statistics = {}  # (scenario, step, group) -> {variable: RunningStatistic}
+        self.histograms = {}  # (scenario, step, group) -> {variable: FixedBinHistogram}
+        # ids of the model runs merged into this reporter, a new unique id if not given
+        self.replicate_ids = {replicate_id if replicate_id is not None else uuid.uuid4().hex}
+
+    @property
+    def replicates(self):
+        """Number of different model runs merged into this reporter."""
+        return len(self.replicate_ids)
+
+    @property
+    def household_attributes(self):
+        """Household attributes read by collect."""
+        return set(self.group_by) | set(self.variables) | set(self.histogram_edges)
+
+    def collect(self, model):
+        """
+        Update the aggregates with the current state of the households of the model in one pass over the agents.
+        In scenario mode (scenario_flood_map_choices) the aggregates are kept for each scenario, with the
+        actual flood depth and damage of that scenario.
+        """
+        households = [agent for agent in model.schedule.agents if isinstance(agent, Households)]
+        scenarios = model.scenario_flood_map_choices
+        # Variables that differ between the scenarios of a scenario mode run, from the model arrays indexed by unique_id
+        scenario_values = None
+        if scenarios is not None:
+            unique_ids = [agent.unique_id for agent in households]
+            scenario_values = {'flood_depth_actual': {scenario: model.scenario_flood_depth_actual[scenario][unique_ids] for scenario in scenarios},
+                               'flood_damage_actual': {scenario: model.scenario_flood_damage_actual[scenario][unique_ids] for scenario in scenarios}}
+        else:
+            scenarios = [model.flood_map_choice]
+        self.collect_households(households, model.schedule.steps, scenarios, scenario_values)
+
+    def collect_households(self, households, step, scenarios, scenario_values=None):
+        """
+        Update the aggregates with the current state of the given households, e.g. the households of one worker process.
+
+        Parameters
+        ----------
+        households: households (or household states) with the group attributes and variables of this reporter
+        step: current step of the model
+        scenarios: flood map choices to keep the aggregates for
+        scenario_values: for the variables that differ between scenarios, the values per scenario as an array
+            aligned with households. None if the households hold the values of the only scenario
+        """
+        scenario_values = scenario_values or {}
+
+        # Gather the values of this step per group, only kept until the end of this call
+        tracked = sorted((set(self.variables) | set(self.histogram_edges)) - set(scenario_values))
+        values = {}
+        for position, household in enumerate(households):
+            group = (household.income_category, household.in_floodplain, household.is_adapted)
+            group_values = values.get(group)
+            if group_values is None:
+                group_values = values[group] = {variable: [] for variable in tracked + ['position']}
+            for variable in tracked:
+                group_values[variable].append(getattr(household, variable))
+            group_values['position'].append(position)
+
+        for scenario in scenarios:
+            for group, group_values in values.items():
+                # look up the scenario specific variables of the households in this group
+                group_values = dict(group_values)
+                for variable, arrays in scenario_values.items():
+                    group_values[variable] = arrays[scenario][group_values['position']]
+
+                key = (scenario, step, group)
+                statistics = self.statistics.setdefault(key, {variable: RunningStatistic() for variable in self.variables})
+                for variable in self.variables:
+                    statistics[variable].update(group_values[variable])
+                histograms = self.histograms.setdefault(key, {variable: FixedBinHistogram(edges) for variable, edges in self.histogram_edges.items()})
+                for variable in self.histogram_edges:
+                    histograms[variable].update(group_values[variable])
+
+    def merge(self, other):
+        """
+        Merge the aggregates of another replicate or worker into this reporter.
+        Reporters with the same replicate_id (workers of the same run) count as a single replicate.
+        """
+        for key, other_statistics in other.statistics.items():
+            statistics = self.statistics.setdefault(key, {variable: RunningStatistic() for variable in other_statistics})
+            for variable, statistic in other_statistics.items():
+                statistics.setdefault(variable, RunningStatistic()).merge(statistic)
+        for key, other_histograms in other.histograms.items():
+            histograms = self.histograms.setdefault(key, {variable: FixedBinHistogram(histogram.bin_edges) for variable, histogram in other_histograms.items()})
+            for variable, histogram in other_histograms.items():
+                histograms.setdefault(variable, FixedBinHistogram(histogram.bin_edges)).merge(histogram)
+        self.replicate_ids |= other.replicate_ids
+        return self
+
+    @classmethod
+    def merge_all(cls, reporters):
+        """Merge a list of reporters (e.g. one per replicate or worker) into a new reporter."""
+        reporters = list(reporters)
+        merged = cls(variables=reporters[0].variables, histograms=reporters[0].histogram_edges)
+        merged.replicate_ids = set()
+        for reporter in reporters:
+            merged.merge(reporter)
+        return merged
+
+    @staticmethod
+    def _sort_key(key):
+        """Sort rows by scenario, then numerically by step, then by group."""
+        scenario, step, *group = key
+        return (str(scenario), step, *map(str, group))
+
+    def marginal(self, variable, by=()):
+        """
+        Return a DataFrame with count, sum, mean and variance of a variable per scenario and step,
+        with the groups merged over all group attributes not in by.
+        The count and sum per replicate are added for adoption curves and damage totals of merged replicates.
+
+        Parameters
+        ----------
+        variable: household variable, one of the variables of the reporter
+        by: group attributes to keep, a subset of ('income_category', 'in_floodplain', 'is_adapted')
+        """
+        positions = [self.group_by.index(attribute) for attribute in by]
+        merged = {}
+        for (scenario, step, group), statistics in self.statistics.items():
+            key = (scenario, step) + tuple(group[position] for position in positions)
+            merged.setdefault(key, RunningStatistic()).merge(statistics[variable])
+        rows = [key + (statistic.count, statistic.total, statistic.mean, statistic.variance,
+                       statistic.count / self.replicates, statistic.total / self.replicates)
+                for key, statistic in sorted(merged.items(), key=lambda item: self._sort_key(item[0]))]
+        columns = ['flood_map_choice', 'Step'] + list(by) + ['count', 'sum', 'mean', 'variance', 'count_per_replicate', 'sum_per_replicate']
+        return pd.DataFrame(rows, columns=columns)
+
+    def marginal_histogram(self, variable, by=()):
+        """
+        Return a DataFrame with the histogram counts of a variable per scenario and step (one column per bin),
+        with the groups merged over all group attributes not in by.
+        Bins are labelled [low, high), except the last bin [low, high], which includes the upper edge.
+        The first and last bin are open-ended: they also count the values below the first or above the last edge.
+        """
+        positions = [self.group_by.index(attribute) for attribute in by]
+        merged = {}
+        for (scenario, step, group), histograms in self.histograms.items():
+            key = (scenario, step) + tuple(group[position] for position in positions)
+            if key not in merged:
+                merged[key] = FixedBinHistogram(histograms[variable].bin_edges)
+            merged[key].merge(histograms[variable])
+        if not merged:
+            return pd.DataFrame()
+        edges = next(iter(merged.values())).bin_edges
+        bins = [f"[{low:g}, {high:g})" for low, high in zip(edges[:-2], edges[1:-1])] + [f"[{edges[-2]:g}, {edges[-1]:g}]"]
+        rows = [key + tuple(histogram.counts) for key, histogram in sorted(merged.items(), key=lambda item: self._sort_key(item[0]))]
+        return pd.DataFrame(rows, columns=['flood_map_choice', 'Step'] + list(by) + bins)